@@ -6,6 +6,8 @@ from optparse import OptionParser
 import logging
 import shutil
 import contextlib
+import re
+import threading
 from collections import defaultdict
 
 SYSTEM_MOUNTPOINTS = frozenset(['proc', 'sys', 'var'])
@@ -57,7 +59,7 @@ def action(fn, *a):
 	return fn(*a)
 
 @contextlib.contextmanager
-def overlayfs(chroot, overlay_roots, sacred_paths=[], prefer_existing_files=[], chroot_dests=True):
+def overlayfs(chroot, overlay_roots, sacred_paths=[], prefer_existing_files=[], chroot_dests=True, eager_paths=None):
 
 	# turn into relative paths (from root)
 	def relative_folder_path(p):
@@ -74,9 +76,15 @@ def overlayfs(chroot, overlay_roots, sacred_paths=[], prefer_existing_files=[],
 	root_folder_name, mounts = init_chroot(chroot)
 	LOGGER.debug("MOUNTS: %r",mounts)
 	root_path = os.path.join(chroot, root_folder_name)
+	if not eager_paths:
+		# an empty profile tells us nothing
+		eager_paths = None
 
 	ensure_dir(root_path)
 	try:
+		if eager_paths is not None:
+			# start readahead early, so that it overlaps with building the overlay
+			prefetch(overlay_roots, eager_paths, sacred_paths, prefer_existing_files)
 		apply_overlay_mapping(chroot, root_folder_name, overlay_roots, sacred_paths, prefer_existing_files, chroot_dests=chroot_dests)
 		LOGGER.debug("MOUNTS: %r",mounts)
 		yield
@@ -149,8 +157,30 @@ def is_prefix_of(a,b):
 	b = os.path.normpath(os.path.join("/",b)) + "/"
 	return b.startswith(a)
 
+def symlinked_dirs(root):
+	'''
+	Return the set of directories (relative to root) which contain
+	a symlink anywhere beneath them, from a single walk of root.
+	'''
+	dirs = set()
+	for parent, dirnames, filenames in os.walk(root):
+		if any([os.path.islink(os.path.join(parent, name)) for name in dirnames + filenames]):
+			relpath = os.path.relpath(parent, root)
+			while relpath not in ('', '.') and relpath not in dirs:
+				dirs.add(relpath)
+				relpath = os.path.dirname(relpath)
+	return dirs
+
 def apply_overlay_mapping(chroot, root_folder_name, overlay_roots, sacred_paths, prefer_existing_files, chroot_dests=True):
+	'''
+	Directories which are only present in a single overlay and contain no
+	symlinks are linked wholesale, since there's nothing underneath them to
+	merge or retarget. Everything else is rebuilt one file at a time.
+	'''
 	ROOT = "/"
+	placed = [0]
+	symlinks_under = dict((root, symlinked_dirs(root)) for root in overlay_roots)
+
 	def try_place(source, relpath):
 		# if relpath in SYSTEM_MOUNTPOINTS:
 		# 	LOGGER.debug("skipping system mount (%s, from %s)", relpath, source)
@@ -187,6 +217,7 @@ def apply_overlay_mapping(chroot, root_folder_name, overlay_roots, sacred_paths,
 			LOGGER.debug("%s already exists - skipping", link_path)
 			return False
 		action(os.symlink, link_dest, link_path)
+		placed[0] += 1
 		return True
 
 	for root in overlay_roots:
@@ -245,6 +276,14 @@ def apply_overlay_mapping(chroot, root_folder_name, overlay_roots, sacred_paths,
 				assert try_place(source, relpath)
 				continue
 
+			if (len(sources) == 1
+					and relpath not in symlinks_under[source]
+					and not os.path.islink(os.path.join(source, relpath))):
+				# nothing to merge or retarget underneath it - so link the whole directory
+				LOGGER.debug("found unshared dir: %s (in %s)", relpath, source)
+				assert try_place(source, relpath)
+				continue
+
 			# otherwise, queue children for processing next loop
 			for source in sources:
 				fullpath = os.path.join(source, relpath)
@@ -254,7 +293,245 @@ def apply_overlay_mapping(chroot, root_folder_name, overlay_roots, sacred_paths,
 				LOGGER.debug("queueing %s (under %s)", relpath, source)
 				next_parents.append((source, relpath))
 		current_parents = next_parents
-	LOGGER.info("overlay complete")
+	LOGGER.info("overlay complete (%d links)", placed[0])
+
+# path arguments of traced syscalls, as (dirfd index, path index) pairs
+TRACED_PATH_ARGS = {}
+for _name in ['open', 'creat', 'access', 'stat', 'lstat', 'stat64', 'lstat64', 'readlink',
+		'chdir', 'execve', 'truncate', 'mkdir', 'rmdir', 'unlink', 'mknod', 'statfs', 'statfs64',
+		'chmod', 'chown', 'lchown', 'utime', 'utimes', 'uselib', 'getxattr', 'lgetxattr',
+		'setxattr', 'lsetxattr', 'listxattr', 'llistxattr', 'removexattr', 'lremovexattr']:
+	TRACED_PATH_ARGS[_name] = [(None, 0)]
+for _name in ['openat', 'openat2', 'newfstatat', 'fstatat64', 'faccessat', 'faccessat2',
+		'readlinkat', 'mkdirat', 'mknodat', 'unlinkat', 'fchmodat', 'fchownat', 'futimesat',
+		'utimensat', 'statx', 'execveat', 'name_to_handle_at']:
+	TRACED_PATH_ARGS[_name] = [(0, 1)]
+for _name in ['rename', 'link']:
+	TRACED_PATH_ARGS[_name] = [(None, 0), (None, 1)]
+for _name in ['renameat', 'renameat2', 'linkat']:
+	TRACED_PATH_ARGS[_name] = [(0, 1), (2, 3)]
+TRACED_PATH_ARGS['symlink'] = [(None, 1)]
+TRACED_PATH_ARGS['symlinkat'] = [(1, 2)]
+FORK_SYSCALLS = frozenset(['clone', 'clone3', 'fork', 'vfork'])
+
+def trace_cmd(log_path, cmd):
+	'''wrap cmd so that all file accesses are logged to log_path'''
+	return ["strace", "-f", "-q", "-y", "-s", "4096", "-e", "trace=file,process,fchdir", "-o", log_path, "--"] + cmd
+
+def split_trace_args(args):
+	'''split the text after "syscall(" into its top-level arguments'''
+	parts = []
+	current = ''
+	depth = 0
+	in_string = False
+	escaped = False
+	for char in args:
+		if in_string:
+			if escaped:
+				escaped = False
+			elif char == '\\':
+				escaped = True
+			elif char == '"':
+				in_string = False
+		elif char == '"':
+			in_string = True
+		elif char in '([{':
+			depth += 1
+		elif char in ')]}':
+			if depth == 0:
+				break
+			depth -= 1
+		elif char == ',' and depth == 0:
+			parts.append(current.strip())
+			current = ''
+			continue
+		current += char
+	parts.append(current.strip())
+	return parts
+
+def parse_trace_string(token):
+	'''return the contents of a quoted strace string, or None if it isn't a complete one'''
+	if len(token) < 2 or not (token.startswith('"') and token.endswith('"')):
+		return None
+	escapes = {'t': '\t', 'n': '\n', 'v': '\v', 'f': '\f', 'r': '\r'}
+	def unescape(match):
+		seq = match.group(1)
+		if seq.startswith('x') and len(seq) == 3:
+			return chr(int(seq[1:], 16))
+		if seq.isdigit():
+			return chr(int(seq, 8))
+		return escapes.get(seq, seq)
+	return re.sub(r'\\(x[0-9a-fA-F]{2}|[0-7]{1,3}|.)', unescape, token[1:-1])
+
+def read_trace(log_path, chroot, overlay_roots=[], chroot_dests=True, cwd=None):
+	'''
+	Return the set of overlay paths (relative to chroot) that were
+	accessed in the strace log (from trace_cmd) at log_path. Failed lookups
+	are included, since library / module searches probe directories they
+	don't find anything in. Relative paths are resolved against each
+	process' working directory, which starts out as cwd.
+
+	This is best-effort: accesses which don't go through a traced
+	syscall (or which strace truncates) are not recorded.
+	'''
+	if cwd is None:
+		cwd = os.getcwd()
+	syscall_line = re.compile(r'^(?:(\d+)\s+)?(\w+)\((.*)$')
+	resumed_line = re.compile(r'^(?:(\d+)\s+)?<\.\.\. \w+ resumed>(.*)$')
+	return_value = re.compile(r'\)\s+=\s+(-?\d+)')
+	fd_path = re.compile(r'^-?\d+<(.*)>$')
+	chroot = os.path.join(os.path.abspath(chroot), "")
+
+	# where each overlay root's files are visible to the traced process
+	root_views = []
+	for root in overlay_roots:
+		root_views.append(os.path.join(root, ""))
+		if chroot_dests:
+			root_views.append(os.path.join("/", ROOT_FOLDER_NAME, root.lstrip("/"), ""))
+
+	def overlay_relpath(path):
+		path = os.path.normpath(path)
+		for view in root_views:
+			if path.startswith(view):
+				return path[len(view):]
+		if chroot_dests:
+			relpath = path.lstrip("/")
+			if is_prefix_of(ROOT_FOLDER_NAME, relpath):
+				return None
+			return relpath
+		if path.startswith(chroot):
+			return path[len(chroot):]
+		return None
+
+	cwds = {}
+	unfinished = {}
+	paths = set()
+	with open(log_path) as log:
+		for line in log:
+			line = line.rstrip("\n")
+			match = resumed_line.match(line)
+			if match:
+				pid, rest = match.groups()
+				if pid not in unfinished:
+					continue
+				line = unfinished.pop(pid) + rest
+			match = syscall_line.match(line)
+			if not match:
+				continue
+			pid, name, args = match.groups()
+			if args.endswith("<unfinished ...>"):
+				unfinished[pid] = line[:-len("<unfinished ...>")].rstrip()
+				continue
+			ret = return_value.search(args)
+			ret = int(ret.group(1)) if ret else None
+			pid_cwd = cwds.setdefault(pid, cwd)
+
+			args = split_trace_args(args)
+			if name in FORK_SYSCALLS:
+				if ret is not None and ret > 0:
+					cwds[str(ret)] = pid_cwd
+				continue
+			if name == 'fchdir':
+				dir_path = fd_path.match(args[0]) if args else None
+				if dir_path and ret == 0:
+					cwds[pid] = dir_path.group(1)
+				continue
+
+			for dirfd_index, path_index in TRACED_PATH_ARGS.get(name, []):
+				if path_index >= len(args):
+					continue
+				path = parse_trace_string(args[path_index])
+				if not path:
+					continue
+				if not os.path.isabs(path):
+					base = pid_cwd
+					if dirfd_index is not None and dirfd_index < len(args) and args[dirfd_index] != 'AT_FDCWD':
+						base = fd_path.match(args[dirfd_index])
+						base = base.group(1) if base else None
+					if base is None:
+						continue
+					path = os.path.join(base, path)
+				path = os.path.normpath(path)
+				if name == 'chdir' and ret == 0:
+					cwds[pid] = path
+				relpath = overlay_relpath(path)
+				if relpath and relpath != '.':
+					paths.add(relpath)
+	return paths
+
+# upper bound on how much prefetch() will ask the kernel to read in
+PREFETCH_LIMIT = 256 * 1024 * 1024
+POSIX_FADV_WILLNEED = 3
+
+def get_fadvise():
+	'''return a function to advise the kernel that a file will be read, or None'''
+	if hasattr(os, 'posix_fadvise'):
+		return lambda fd, length: os.posix_fadvise(fd, 0, length, os.POSIX_FADV_WILLNEED)
+	try:
+		import ctypes, ctypes.util
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		fadvise = libc.posix_fadvise64
+	except (ImportError, OSError, AttributeError) as e:
+		LOGGER.debug("posix_fadvise unavailable - %s: %s", type(e).__name__, e)
+		return None
+	fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+	def advise(fd, length):
+		err = fadvise(fd, 0, length, POSIX_FADV_WILLNEED)
+		if err != 0:
+			raise OSError(err, os.strerror(err))
+	return advise
+
+def prefetch_sources(overlay_roots, relpaths, sacred_paths=[], prefer_existing_files=[]):
+	'''
+	Return the unpacked files which the overlay will use for relpaths.
+	Paths which are served from the host, or which pass through a
+	symlink (and would be retargeted by the overlay), are skipped.
+	'''
+	def resolve(relpath):
+		if any([relpath.startswith(base) for base in sacred_paths]):
+			return None
+		if any([relpath.startswith(base) for base in prefer_existing_files]) and os.path.isfile(os.path.join("/", relpath)):
+			return None
+		for root in overlay_roots:
+			path = os.path.join(root, relpath)
+			if not os.path.lexists(path):
+				continue
+			if os.path.realpath(path) != os.path.join(os.path.realpath(root), relpath) or not os.path.isfile(path):
+				return None
+			return path
+		return None
+	return list(filter(None, map(resolve, sorted(relpaths))))
+
+def prefetch(overlay_roots, relpaths, sacred_paths=[], prefer_existing_files=[]):
+	'''
+	Ask the kernel to start reading the unpacked files behind relpaths into
+	the page cache (up to PREFETCH_LIMIT bytes), from a background thread.
+	This only issues readahead hints - nothing is read if
+	posix_fadvise is unavailable.
+	'''
+	fadvise = get_fadvise()
+	if fadvise is None or DRY_RUN:
+		return
+
+	def run():
+		count = 0
+		remaining = PREFETCH_LIMIT
+		for path in prefetch_sources(overlay_roots, relpaths, sacred_paths, prefer_existing_files):
+			try:
+				size = os.path.getsize(path)
+				if size > remaining:
+					continue
+				with open(path, 'rb') as f:
+					fadvise(f.fileno(), size)
+				remaining -= size
+				count += 1
+			except (IOError, OSError) as e:
+				LOGGER.debug("Can't prefetch %s - %s: %s", path, type(e).__name__, e)
+		LOGGER.debug("prefetched %d files (%d bytes)", count, PREFETCH_LIMIT - remaining)
+
+	thread = threading.Thread(target=run, name="prefetch")
+	thread.daemon = True
+	thread.start()
 
 
 
@@ -274,6 +274,57 @@ def download_all(name, package_map, exclude=[]):
 		unpacked_paths.append(unpacked)
 	return unpacked_paths
 
+def profile_key(spec, cmd, roots, package_map):
+	'''identifies a run: the spec, the command and the exact package versions used'''
+	packages = []
+	for root in sorted(roots):
+		package_id = os.path.basename(root)
+		packages.append([package_id, package_map[package_id]['Version']])
+	return {'spec': spec, 'command': cmd, 'packages': packages}
+
+def profile_path(key):
+	import json
+	key_id = hashlib.md5(json.dumps(key, sort_keys=True)).hexdigest()[:10]
+	return os.path.join(CACHE_DIR, "profiles", "%s.json" % (key_id,))
+
+def load_profile(key):
+	import json
+	path = profile_path(key)
+	if not os.path.exists(path):
+		return None
+	with open(path) as f:
+		paths = set(json.load(f))
+	if not paths:
+		LOGGER.warn("Ignoring empty access profile %s", path)
+		return None
+	LOGGER.info("Using access profile %s", path)
+	return paths
+
+def save_profile(key, paths):
+	import json
+	if not paths:
+		LOGGER.warn("Trace recorded no overlay paths - not saving an access profile")
+		return
+	path = profile_path(key)
+	if not os.path.exists(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	LOGGER.info("Saving access profile (%d paths) -> %s", len(paths), path)
+	with open(path, 'w') as f:
+		json.dump(sorted(paths), f, indent=1)
+
+def env_args(env, use_chroot, tempdir):
+	args = ['env']
+	for key, val in env.items():
+		if isinstance(val, list):
+			# prepend it:
+			existing = list(filter(None, os.environ.get(key, '').split(":")))
+			val = (val + existing)
+			if not use_chroot:
+				val = [os.path.normpath("%s/%s" % (tempdir, v)) for v in val]
+			val = ":".join(val)
+		args.append("%s=%s" % (key, val))
+	return args
+
 def main():
 	import optparse
 	p = optparse.OptionParser("usage: rundeb [OPTS] specfile -- [arg ...]")
@@ -282,6 +333,8 @@ def main():
 	p.add_option("-n", "--no-chroot", action="store_true")
 	p.add_option("-c", "--ignore-command", action="store_true")
 	p.add_option("-d", "--debug", action="store_true", help="wait for user input before cleaning up")
+	p.add_option("-t", "--trace", action="store_true", help="record which overlay paths the command accesses (requires strace)")
+	p.add_option("--no-profile", action="store_true", help="ignore any recorded access profile")
 	opts, cmd = p.parse_args()
 	assert len(cmd) > 0, "must provide a spec file"
 	specfile = cmd.pop(0)
@@ -323,6 +376,8 @@ def main():
 
 	roots = download_all(spec['package'], package_map, exclude=["libc6"])
 	roots = list(map(os.path.abspath, roots))
+	# (taken before the command is wrapped with env / proot / strace)
+	profile_id = profile_key(spec, cmd, roots, package_map)
 
 	tempdir = tempfile.mkdtemp()
 
@@ -330,30 +385,36 @@ def main():
 	if opts.no_chroot:
 		use_chroot = False
 	if spec['env']:
-		args = ['env']
-		for key, val in spec['env'].items():
-			if isinstance(val, list):
-				# prepend it:
-				existing = list(filter(None, os.environ.get(key, '').split(":")))
-				val = (val + existing)
-				if not use_chroot:
-					val = [os.path.normpath("%s/%s" % (tempdir, v)) for v in val]
-				val = ":".join(val)
-			args.append("%s=%s" % (key, val))
-		cmd = args + cmd
+		cmd = env_args(spec['env'], use_chroot, tempdir) + cmd
+
+	eager_paths = None
+	if not (opts.trace or opts.no_profile):
+		eager_paths = load_profile(profile_id)
+
+	trace_log = None
+	if opts.trace:
+		# the log must be at the same path inside the chroot, and /tmp is shared
+		fd, trace_log = tempfile.mkstemp(prefix="rundeb-trace-", dir="/tmp")
+		os.close(fd)
+		cmd = make_overlay.trace_cmd(trace_log, cmd)
 
 	LOGGER.info("making chroot in: %s", tempdir)
-	with make_overlay.overlayfs(chroot = tempdir, overlay_roots = roots, sacred_paths = ['/home', '/tmp'], prefer_existing_files=['/etc'], chroot_dests=use_chroot):
+	with make_overlay.overlayfs(chroot = tempdir, overlay_roots = roots, sacred_paths = ['/home', '/tmp'], prefer_existing_files=['/etc'], chroot_dests=use_chroot, eager_paths=eager_paths):
 		if use_chroot:
 			cmd = ["proot", "-r", tempdir, "--bind=/:/" + make_overlay.ROOT_FOLDER_NAME] + cmd
 		print "running cmd: %r" % (cmd,)
 		print "overlay root: %s" % (tempdir,)
 		try:
 			subprocess.check_call(cmd)
+			if trace_log is not None:
+				# only a complete, successful run gives a useful profile
+				save_profile(profile_id, make_overlay.read_trace(trace_log, tempdir, overlay_roots=roots, chroot_dests=use_chroot))
 		except subprocess.CalledProcessError as e:
 			LOGGER.info("command failed.")
 			sys.exit(1)
 		finally:
+			if trace_log is not None:
+				os.remove(trace_log)
 			if opts.debug:
 				print "Command exited. Press return to continue cleanup (tempdir = %s)" % (tempdir,)
 				raw_input()
@@ -0,0 +1,147 @@
+import os
+import textwrap
+
+import make_overlay
+
+# a top-level name which won't clash with anything on the host
+TOP = 'make_overlay_test'
+
+def touch(path):
+	if not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	open(path, 'w').close()
+
+def make_overlays(tmpdir):
+	a = str(tmpdir.join('a'))
+	b = str(tmpdir.join('b'))
+	touch(os.path.join(a, TOP, 'share/x/fa'))
+	touch(os.path.join(b, TOP, 'share/x/fb'))
+	os.symlink('fb', os.path.join(b, TOP, 'share/x/link'))
+	touch(os.path.join(a, TOP, 'lib/real'))
+	touch(os.path.join(a, TOP, 'only_a/deep/f'))
+	touch(os.path.join(b, TOP, 'only_b/f'))
+	os.symlink('f', os.path.join(b, TOP, 'only_b/link'))
+	return [a, b]
+
+def build(tmpdir, overlay_roots):
+	chroot = str(tmpdir.join('chroot'))
+	make_overlay.apply_overlay_mapping(chroot, make_overlay.ROOT_FOLDER_NAME, overlay_roots, [], [], chroot_dests=False)
+	return os.path.join(chroot, TOP)
+
+def listing(path):
+	contents = []
+	for parent, dirnames, filenames in os.walk(path, followlinks=True):
+		for name in dirnames + filenames:
+			contents.append(os.path.relpath(os.path.join(parent, name), path))
+	return sorted(contents)
+
+def links(path):
+	found = []
+	for parent, dirnames, filenames in os.walk(path):
+		for name in dirnames + filenames:
+			if os.path.islink(os.path.join(parent, name)):
+				found.append(os.path.relpath(os.path.join(parent, name), path))
+	return sorted(found)
+
+def test_merged_dirs_keep_every_source(tmpdir):
+	top = build(tmpdir, make_overlays(tmpdir))
+	assert sorted(os.listdir(os.path.join(top, 'share/x'))) == ['fa', 'fb', 'link']
+	assert listing(top) == [
+		'lib', 'lib/real',
+		'only_a', 'only_a/deep', 'only_a/deep/f',
+		'only_b', 'only_b/f', 'only_b/link',
+		'share', 'share/x', 'share/x/fa', 'share/x/fb', 'share/x/link',
+	]
+
+def test_unshared_dirs_linked_wholesale(tmpdir):
+	top = build(tmpdir, make_overlays(tmpdir))
+	assert links(top) == [
+		'lib',
+		'only_a',
+		# dirs containing symlinks still get traversed, so the links are retargeted
+		'only_b/f', 'only_b/link',
+		'share/x/fa', 'share/x/fb', 'share/x/link',
+	]
+
+def test_symlinked_dirs(tmpdir):
+	root = str(tmpdir)
+	touch(os.path.join(root, 'a/b/c/f'))
+	os.symlink('f', os.path.join(root, 'a/b/c/link'))
+	touch(os.path.join(root, 'a/other/f'))
+	os.symlink('a/other', os.path.join(root, 'dirlink'))
+	assert make_overlay.symlinked_dirs(root) == set(['a', 'a/b', 'a/b/c'])
+
+def test_prefetch_sources(tmpdir):
+	a = str(tmpdir.join('a'))
+	b = str(tmpdir.join('b'))
+	touch(os.path.join(a, 'lib/real.so'))
+	os.symlink('/lib/host.so', os.path.join(a, 'lib/abs.so'))
+	os.symlink('real.so', os.path.join(a, 'lib/rel.so'))
+	touch(os.path.join(b, 'lib/rel.so'))
+	touch(os.path.join(b, 'lib/only_b.so'))
+	os.symlink('lib', os.path.join(a, 'liblink'))
+
+	# a file on the host, which prefer_existing_files gives precedence to
+	host_dir = tmpdir.join('host')
+	touch(str(host_dir.join('conf')))
+	host_relpath = os.path.relpath(str(host_dir), '/')
+	touch(os.path.join(a, host_relpath, 'conf'))
+	touch(os.path.join(a, host_relpath, 'unshadowed'))
+
+	relpaths = ['lib/real.so', 'lib/abs.so', 'lib/rel.so', 'lib/only_b.so', 'lib/missing.so', 'liblink/real.so',
+		os.path.join(host_relpath, 'conf'), os.path.join(host_relpath, 'unshadowed')]
+	assert set(make_overlay.prefetch_sources([a, b], relpaths, prefer_existing_files=[os.path.join(host_relpath, '')])) == set([
+		os.path.join(a, 'lib/real.so'),
+		os.path.join(b, 'lib/only_b.so'),
+		os.path.join(a, host_relpath, 'unshadowed'),
+	])
+
+def write_log(tmpdir, contents):
+	log = tmpdir.join('trace.log')
+	log.write(textwrap.dedent(contents))
+	return str(log)
+
+def test_read_trace_chroot(tmpdir):
+	log = write_log(tmpdir, '''\
+		100 execve("/usr/bin/app", ["app", "/etc/not-a-path"], 0x7ffc /* 3 vars */) = 0
+		100 openat(AT_FDCWD, "/usr/lib/libfoo.so", O_RDONLY|O_CLOEXEC) = 3</usr/lib/libfoo.so>
+		100 openat(AT_FDCWD, "/usr/lib/missing.so", O_RDONLY|O_CLOEXEC) = -1 ENOENT (No such file or directory)
+		100 stat("/__root/home/user", {st_mode=S_IFDIR|0755, st_size=4096, ...}) = 0
+		100 openat(AT_FDCWD, "/__root/src/pkg/usr/share/resolved", O_RDONLY) = 3</__root/src/pkg/usr/share/resolved>
+		100 openat(AT_FDCWD, "rel/file", O_RDONLY) = 3</work/rel/file>
+		100 clone(child_stack=NULL, flags=CLONE_CHILD_SETTID|SIGCHLD, child_tidptr=0x7f) = 101
+		101 chdir("/opt/app") = 0
+		101 openat(AT_FDCWD, "data/a \\"quoted\\" name", O_RDONLY <unfinished ...>
+		100 access("/etc/ld.so.preload", R_OK) = -1 ENOENT (No such file or directory)
+		101 <... openat resumed>) = 4</opt/app/data/a "quoted" name>
+		101 newfstatat(4</opt/app/data>, "b", {st_mode=S_IFREG|0644, st_size=1, ...}, 0) = 0
+		101 +++ exited with 0 +++
+		100 openat(AT_FDCWD, "rel/again", O_RDONLY) = -1 ENOENT (No such file or directory)
+	''')
+	assert make_overlay.read_trace(log, '/tmp/chroot', overlay_roots=['/src/pkg'], cwd='/work') == set([
+		'usr/bin/app',
+		'usr/lib/libfoo.so',
+		'usr/lib/missing.so',
+		'usr/share/resolved',
+		'work/rel/file',
+		'opt/app',
+		'opt/app/data/a "quoted" name',
+		'opt/app/data/b',
+		'etc/ld.so.preload',
+		'work/rel/again',
+	])
+
+def test_read_trace_no_chroot(tmpdir):
+	log = write_log(tmpdir, '''\
+		100 openat(AT_FDCWD, "/tmp/chroot/usr/lib/libfoo.so", O_RDONLY) = 3</src/pkg/usr/lib/libfoo.so>
+		100 openat(AT_FDCWD, "/src/pkg/usr/lib/libbar.so", O_RDONLY) = 3</src/pkg/usr/lib/libbar.so>
+		100 openat(AT_FDCWD, "/etc/passwd", O_RDONLY) = 3</etc/passwd>
+		100 chdir("/tmp/chroot/usr") = 0
+		100 openat(AT_FDCWD, "share/x", O_RDONLY) = -1 ENOENT (No such file or directory)
+	''')
+	assert make_overlay.read_trace(log, '/tmp/chroot', overlay_roots=['/src/pkg'], chroot_dests=False, cwd='/') == set([
+		'usr/lib/libfoo.so',
+		'usr/lib/libbar.so',
+		'usr',
+		'usr/share/x',
+	])
@@ -0,0 +1,61 @@
+import json
+import os
+import sys
+
+import pytest
+
+# rundeb is python 2 only, and needs python-debian & pyxdg
+if sys.version_info[0] > 2:
+	pytest.skip("rundeb requires python 2", allow_module_level=True)
+rundeb = pytest.importorskip('rundeb')
+
+SPEC = {
+	'package': 'app',
+	'repos': [],
+	'env': {'PATH': ['/usr/bin']},
+	'command': ['app'],
+}
+ROOTS = ['/cache/debs-unpacked/app', '/cache/debs-unpacked/libapp']
+
+def package_map(app_version='1.0'):
+	return {'app': {'Version': app_version}, 'libapp': {'Version': '2.0'}}
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmpdir, monkeypatch):
+	monkeypatch.setattr(rundeb, 'CACHE_DIR', str(tmpdir))
+
+def profile_path(spec=SPEC, cmd=['app'], app_version='1.0'):
+	return rundeb.profile_path(rundeb.profile_key(spec, cmd, ROOTS, package_map(app_version)))
+
+def test_profile_key_covers_spec_command_and_versions():
+	other_spec = dict(SPEC, package='other')
+	paths = [
+		profile_path(),
+		profile_path(spec=other_spec),
+		profile_path(cmd=['app', '--flag']),
+		profile_path(app_version='1.1'),
+	]
+	assert len(set(paths)) == len(paths)
+	assert profile_path() == profile_path()
+
+def test_env_args():
+	assert rundeb.env_args({'HOME': '/home/app'}, True, '/tmp/chroot') == ['env', 'HOME=/home/app']
+	assert rundeb.env_args({'APP_PATH': ['/usr/lib']}, False, '/tmp/chroot') == ['env', 'APP_PATH=/tmp/chroot/usr/lib']
+
+def test_save_and_load_profile():
+	key = rundeb.profile_key(SPEC, ['app'], ROOTS, package_map())
+	rundeb.save_profile(key, set(['usr/lib/libapp.so', 'usr/bin/app']))
+	assert rundeb.load_profile(key) == set(['usr/lib/libapp.so', 'usr/bin/app'])
+
+	upgraded = rundeb.profile_key(SPEC, ['app'], ROOTS, package_map('1.1'))
+	assert rundeb.load_profile(upgraded) is None
+
+def test_empty_profiles_are_ignored():
+	key = rundeb.profile_key(SPEC, ['app'], ROOTS, package_map())
+	rundeb.save_profile(key, set())
+	assert not os.path.exists(rundeb.profile_path(key))
+
+	os.makedirs(os.path.dirname(rundeb.profile_path(key)))
+	with open(rundeb.profile_path(key), 'w') as f:
+		json.dump([], f)
+	assert rundeb.load_profile(key) is None